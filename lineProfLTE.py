@@ -21,9 +21,14 @@ Most recently edited: Dec 31, 2016
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ########################################################################
 
+import math
+import types
+from functools import lru_cache
 import numpy as np
-from scipy.integrate import odeint, quad, ode
-from scipy.optimize import fmin
+from collections import namedtuple
+from scipy.integrate import odeint
+from scipy.interpolate import PchipInterpolator
+from numba import njit, prange
 from .emitterData import emitterData
 from .despoticError import despoticError
 
@@ -48,7 +53,8 @@ small = 1e-50
 def lineProfLTE(emdat, u, l, R, denProf, TProf,
                 vProf=0.0, sigmaProf=0.0,
                 offset=0.0, TCMB=2.73, vOut=None, vLim=None,
-                nOut=100, dv=None, mxstep=10000, beamdisp=0.0):
+                nOut=100, dv=None, mxstep=10000, beamdisp=0.0,
+                integrator='lsoda', rtol=1e-8, atol=1e-12, device='cpu'):
     """
     Return the brightness temperature versus velocity for a
     specified line, assuming the level populations are in LTE. The
@@ -101,6 +107,32 @@ def lineProfLTE(emdat, u, l, R, denProf, TProf,
            of the cloud radius; a value of 0 causes the integration do
            be done alone a perfect pencil beam; not currently compatible
            with offset != 0
+        integrator : 'lsoda' | 'rk45'
+           ODE integrator used for pencil beams (beamdisp = 0);
+           'lsoda' integrates all velocities together as a single
+           vector ODE using odeint, while 'rk45' integrates each
+           velocity separately with a compiled solver, running the
+           velocities in parallel; despite the name, which is kept
+           for compatibility, this is an L-stable implicit
+           Runge-Kutta method of order 4, so that it can also
+           integrate optically thick lines
+        rtol : float
+           relative error tolerance of the ODE solver, applied to the
+           intensity of the line above the CMB
+        atol : float
+           absolute error tolerance of the ODE solver, applied to the
+           intensity of the line above the CMB, in units of the
+           characteristic intensity of the cloud; intensities below
+           atol are not resolved, and since the brightness
+           temperature depends only logarithmically on the intensity,
+           brightness temperatures computed from them are unreliable.
+           With the default tolerances, brightness temperatures above
+           a few tenths of a K are typically accurate to 1e-4 K
+        device : 'cpu' | 'cuda'
+           where to run the compiled integrator, which is used for
+           integrator = 'rk45' and for Gaussian beams; 'cuda' runs
+           one velocity per GPU thread, and requires numba's CUDA
+           support and a GPU
 
     Returns
         TB : array
@@ -111,7 +143,9 @@ def lineProfLTE(emdat, u, l, R, denProf, TProf,
     Raises
         despoticError is the specified upper and lower state have no
         radiative transition between them, or if offset is not in the
-	range 0 - 1
+	range 0 - 1, if integrator or device is not recognized, if
+        device = 'cuda' is used with integrator = 'lsoda' for a pencil
+        beam, or if the ODE integration fails
 
     Remarks
         The functions denProf, TProf, vProf, and sigmaProf, if
@@ -121,6 +155,13 @@ def lineProfLTE(emdat, u, l, R, denProf, TProf,
         and the edge at r = 1. The return value should be the density,
         temperature, velocity, or non-thermal velocity dispesion at
         that position, in cgs units. 
+
+        The tables built from emdat and the profiles are cached, and
+        reused when lineProfLTE is called again with the same emdat
+        object, states, radius, profiles, and offset. Callable
+        profiles are matched by identity, so a profile object whose
+        behavior is changed in place between calls, or an emdat
+        whose data are changed in place, will give stale results.
     """
 
     # Step 1: safety check
@@ -133,70 +174,126 @@ def lineProfLTE(emdat, u, l, R, denProf, TProf,
     if beamdisp > 0.0 and offset > 0.0:
         raise despoticError(
             'offset > 0 with Gaussian beams not yet implemented')
+    if integrator not in ['lsoda', 'rk45']:
+        raise despoticError('unknown integrator '+str(integrator))
+    if device not in ['cpu', 'cuda']:
+        raise despoticError('unknown device '+str(device))
+    if device == 'cuda' and integrator == 'lsoda' and beamdisp == 0.0:
+        raise despoticError(
+            "device 'cuda' requires integrator 'rk45' for pencil beams")
 
     # Step 2: set up the helper class to compute normalization
-    # constants
-    te = _transferEqn(emdat, u, l, R, denProf, TProf, vProf,
-		      sigmaProf, offset)
+    # constants; reuse it if lineProfLTE has been called with the same
+    # cloud before
+    te = _getTransferEqn(emdat, u, l, R, denProf, TProf, vProf,
+                         sigmaProf, offset)
 
     # Step 3: construct list of velocities at which to output
-    if vOut == None:
-        if dv == None:
-            if vLim == None:
+    if vOut is None:
+        if dv is None:
+            if vLim is None:
                 # No input given, so take velocity limits to be
                 # offset from line center by max of 5*sigmaTot + abs(v0)
                 vLim = [-5*te.sigmaTot - abs(te.v0),
                         5*te.sigmaTot + abs(te.v0)]
             # Compute vOut from vLim and nOut
-            vOut = np.arange(vLim[0], vLim[1]*(1.0+1e-6),
-                             (vLim[1]-vLim[0])/(nOut-1))
+            vOut = np.linspace(vLim[0], vLim[1], nOut)
         else:
             # dv is non-zero, so set velocities from dv and nOut
-            vOut = np.arange(-dv*(nOut/2.0),
-                             dv*(nOut/2.0+1.0e-6), dv)
-        
+            vOut = np.linspace(-dv*(nOut/2.0), dv*(nOut/2.0), nOut+1)
+    else:
+        vOut = np.asarray(vOut, dtype=float)
 
 
-    # Step 4: get line profile
-    iOut = np.zeros(vOut.shape)
-    all_rhs_vals=[]
-    vels=[]
-    for i in range(vOut.size):
-
-        # Get velocity
-        v = vOut.flat[i]
 
-        # Integrate at this velocity
-        if beamdisp == 0.0:
+    # Step 4: get line profile
 
-            # Beam dispersion is zero; just call pencil case
-            iOut.flat[i] = LineProfLTE_pencil(
-                v, te, offset=offset, TCMB=TCMB, mxstep=mxstep)
-                                         
+    # Get frequencies normalized to line-center value, the side of
+    # the cloud on which the emission at each peaks, and the
+    # normalized CMB intensity at each of them; these are the same
+    # whichever way the line profile is computed
+    f = 1 + vOut.ravel()/c
+    sign = np.copysign(1.0, vOut.ravel())
+    ICMB = (2*h*te.freq**3/c**2) / \
+           np.expm1(h*f*te.freq/(kB*TCMB)) / te.I0
+
+    if beamdisp == 0.0 and integrator == 'lsoda':
+
+        # Beam dispersion is zero, so every velocity is an
+        # independent pencil-beam ODE along the same path; only the
+        # frequency f changes between them. Integrate them together
+        # as a single vector-valued ODE, one component per velocity,
+        # so that the solver is invoked once rather than once per
+        # velocity. The components do not couple, so tell the solver
+        # that the Jacobian is diagonal (ml = mu = 0), and give it
+        # the analytic Jacobian so it need not difference the RHS.
+        # The steps are limited to te.hmax, so that the solver
+        # cannot step over the emission peak of any velocity. The
+        # unknown is the intensity above the CMB, so that the error
+        # tolerances apply to the line rather than to the background.
+        # odeint only warns if it fails, and returns whatever it had
+        # reached, so check its status.
+        sLim = [-np.sqrt(1.0-offset**2), np.sqrt(1.0-offset**2)]
+        iOut, info = odeint(te.rhs, np.zeros(f.size), sLim,
+                            mxstep=mxstep, atol=atol, rtol=rtol,
+                            ml=0, mu=0, Dfun=te.jac, hmax=te.hmax,
+                            args=(f, ICMB), full_output=1)
+        if info['message'] != 'Integration successful.':
+            raise despoticError(
+                'ODE integration failed: '+info['message'])
+        iOut = iOut[1].reshape(vOut.shape)
+
+    elif beamdisp == 0.0:
+
+        # Beam dispersion is zero, and we are to integrate each
+        # velocity separately. Hand all the velocities to the
+        # compiled integrator, which runs them in parallel.
+        if device == 'cuda':
+            iOut = _cuda_grid(f, ICMB, sign, np.array([offset]),
+                              te.params, atol, rtol, mxstep)
         else:
+            iOut = _pencil_grid(f, ICMB, sign, offset, te.params,
+                                atol, rtol, mxstep)
+        iOut = iOut.reshape(vOut.shape)
+
+    else:
+
+        # Beam dispersion is non-zero, so the intensity is the mean
+        # over the beam of pencil beams at offsets r from the center,
+        # weighted by the Gaussian beam profile. Do the integral over
+        # r by Gauss-Legendre quadrature, folding the beam profile
+        # into the weights. The nodes go on [0, rMax], with rMax = 1
+        # or 6 beam dispersions, whichever is smaller, so that they
+        # resolve a narrow beam; the beam beyond 6 dispersions carries
+        # a fraction exp(-18) of the weight. The pencil beams for
+        # every pair of velocity and node are independent, so the
+        # compiled integrator does them all together in parallel.
+        rMax = min(1.0, 6.0*beamdisp)
+        rNode, wNode = np.polynomial.legendre.leggauss(16)
+        rNode = 0.5*rMax*(rNode+1.0)
+        wNode = 0.5*rMax*wNode * rNode*np.exp(-rNode**2/(2*beamdisp**2)) / \
+                beamdisp**2
+        if device == 'cuda':
+            iOut = _cuda_grid(f, ICMB, sign, rNode, te.params,
+                              atol, rtol, mxstep) @ wNode
+        else:
+            iOut = _beam_grid(f, ICMB, sign, rNode, wNode, te.params,
+                              atol, rtol, mxstep)
+        iOut = iOut.reshape(vOut.shape)
 
-            # Beam dispersion is non-zero
-            iOut.flat[i] = 1.0/beamdisp**2 * \
-            quad(lambda r: r * np.exp(-r**2/(2*beamdisp**2)) *
-                 LineProfLTE_pencil(v, te, offset=offset, TCMB=TCMB,
-                                    mxstep=mxstep),
-                 0, 1)[0]
-
-        #rhss=LineProfLTE_pencil2(v, te, offset=offset, TCMB=TCMB,
-        #                            mxstep=mxstep)
-        #all_rhs_vals.append(rhss[0])
-        #vels.append(v)
+    # The compiled integrator flags failures with nan
+    if np.isnan(iOut).any():
+        raise despoticError(
+            'ODE integration failed to converge in mxstep steps')
 
     # Step 5: convert intensity to brightness temperature; be
     # careful to handle 0 or negative intensities correctly
-    TB = (h*emdat.freq[u,l]/kB) / \
-         np.log(1.0 + 2.0*h*emdat.freq[u,l]**3 / \
-		(c**2*abs(iOut)*te.I0+small))
-    TB[iOut < 0] *= -1.0
-    TB[iOut == 0.0] = 0.0
+    TB = _brightnessTemp(iOut.ravel(), h*emdat.freq[u,l]/kB,
+                         2.0*h*emdat.freq[u,l]**3/c**2,
+                         te.I0).reshape(iOut.shape)
    
     # Step 6: return
-    return TB, vOut     #  , all_rhs_vals, vels
+    return TB, vOut
 
 
 ########################################################################
@@ -206,7 +303,8 @@ def lineProfLTE(emdat, u, l, R, denProf, TProf,
 # checking, or input sanitisation is done.
 ########################################################################
 
-def LineProfLTE_pencil(v, te, offset=0.0, TCMB=2.73, mxstep=10000):
+def LineProfLTE_pencil(v, te, offset=0.0, TCMB=2.73, mxstep=10000,
+                       ICMB=None, rtol=1e-8, atol=1e-12):
         """
         Return the intensity for a specified line at a specified
         velocity, assuming the level populations are in LTE. The
@@ -228,6 +326,15 @@ def LineProfLTE_pencil(v, te, offset=0.0, TCMB=2.73, mxstep=10000):
            mxstep : int
               maximum number of steps in the ODE solver; default is
               10,000
+           ICMB : float
+              normalized CMB intensity at the frequency corresponding
+              to v; if omitted, it is computed from TCMB
+           rtol : float
+              relative error tolerance of the ODE solver, applied to
+              the intensity above the CMB
+           atol : float
+              absolute error tolerance of the ODE solver, applied to
+              the intensity above the CMB
 
         Returns
            intensity : array
@@ -236,7 +343,7 @@ def LineProfLTE_pencil(v, te, offset=0.0, TCMB=2.73, mxstep=10000):
 	Raises
 	   despoticError is the specified upper and lower state have no
 	   radiative transition between them, or if offset is not in the
-	   range 0 - 1
+	   range 0 - 1, or if the ODE integration fails
 
         Remarks
            The functions denProf, TProf, vProf, and sigmaProf, if
@@ -253,59 +360,21 @@ def LineProfLTE_pencil(v, te, offset=0.0, TCMB=2.73, mxstep=10000):
         f = 1 + v/c
 
         # Get normalized CMB intensity at line frequency
-        ICMB = (2*h*te.freq**3/c**2) / \
-               (np.exp(h*f*te.freq/(kB*TCMB))-1.0) / te.I0
+        if ICMB is None:
+            ICMB = (2*h*te.freq**3/c**2) / \
+                   np.expm1(h*f*te.freq/(kB*TCMB)) / te.I0
        
-        #Calculate radius at the line of sight with te
-        if v<0:
-            sign=-1
-        else:
-            sign=1
-
-        r_losarray=fmin(lambda x: -te.rhs(ICMB,sign*x,f),0.001,xtol=10**-5,full_output=1,disp=0,retall=1)
-        r_los=r_losarray[0][0]
-        
-        rhs_val=[]
-        # Evaluate the integral                 
-        if r_los < 1:
-            xLim = [-1, -1.1*r_los, -r_los, -r_los/10, -r_los/100, r_los/100, r_los/10, r_los, 1.1*r_los, 1]
-            logscale = [True, True, True, True, False, True, True, True, True, True]
-            sgn = [-1, -1, -1, -1, -1, 0, 1, 1, 1, 1, 1]
-                             
-            Itmpd5_final = ICMB 
-            Itmp = ICMB
-            for i in range(len(xLim)-1):            
-                if logscale[i]:
-                    #Itmpd5 = ode(te.rhs_log_ode).set_integrator('Isoda', atol=1e-11, rtol=1e-11, max_step=10000)
-                    #Itmpd5.set_initial_value(Itmpd5_final,np.log(sgn[i]*xLim[i])).set_f_params(te, f, sgn[i])
-                    #Itmpd5_final=Itmpd5.integrate(np.log(sgn[i]*xLim[i+1]))[0]
-
-                    Itmp = odeint(te.rhs_log, Itmp, [np.log(sgn[i]*xLim[i]), np.log(sgn[i]*xLim[i+1])],
-                              mxstep=10000, atol=1e-11, rtol=1e-11, args=(te, f, sgn[i]))[1]
-
-                else:  
-                    #Itmpd5 = ode(te.rhs_ode).set_integrator('Isoda',atol=1e-11, rtol=1e-11, max_step=10000)
-                    #Itmpd5.set_initial_value(Itmpd5_final,xLim[i]).set_f_params(f,)
-                    #Itmpd5_final=Itmpd5.integrate(xLim[i+1])[0]
-
-                    Itmp = odeint(te.rhs, Itmp, [xLim[i], xLim[i+1]], mxstep=10000,
-                              atol=1e-11, rtol=1e-11, args=(f,))[1]
-             
-        else:
-            sLim = [-np.sqrt(1.0-offset**2), np.sqrt(1.0-offset**2)]
-            #Itmpd5 = ode(te.rhs_ode).set_integrator('Isoda', atol=1e-11, rtol=1e-11, max_step=10000)
-            #Itmpd5.set_initial_value(ICMB,sLim[0]).set_f_params(f)
-            #Itmpd5_final=Itmpd5.integrate(sLim[1])[0]
-
-            Itmp = odeint(te.rhs, ICMB, sLim,
-                          mxstep=mxstep, atol=1e-11, rtol=1e-11,
-                              args = (f,))[1]
-                
-
-        # Subtract off the CMB
-        #Itmpd5_final-=ICMB
-        Itmp-=ICMB
-        intensity=Itmp
+        # Side of the cloud on which the line of sight emission peaks
+        sign = math.copysign(1.0, v)
+
+        # Evaluate the integral and subtract off the CMB; this is done
+        # by the compiled integrator, which works on the tabulated
+        # profiles held in te.params
+        intensity = _pencil_at_v(f, ICMB, sign, offset, te.params,
+                                 atol, rtol, mxstep)
+        if np.isnan(intensity):
+            raise despoticError(
+                'ODE integration failed to converge in mxstep steps')
         
         # Return
         return intensity
@@ -313,122 +382,541 @@ def LineProfLTE_pencil(v, te, offset=0.0, TCMB=2.73, mxstep=10000):
 
 
 ########################################################################
-# These are helper classes into which we load all the information we
-# need about the various parameters in the transfer equation, so that
-# we don't have to keep passing them around.
+# Helpers for LineProfLTE_pencil and lineProfLTE
+#
+# The compiled functions that do the pencil beam integrations, here
+# and below, are shared with the GPU: _cudaKernel compiles the ones
+# listed in _cudaDevice again as CUDA device functions, from their
+# python sources, with the global name np bound to the math module.
+# They may therefore use only scalar arithmetic, each other,
+# read-only module-level arrays such as _xSegFrac, and those np
+# names that the math module also has (sqrt, exp, log, sin, isnan,
+# pi, nan). An array operation, or any other np function, still
+# compiles for the CPU, and breaks only the GPU build.
 ########################################################################
-class _normFunc:
-    def __init__(self, func, norm):
-        self.func = func
-        self.norm = norm
-    def f(self, arg):
-        return self.func(arg) / self.norm
 
-class _normFunc2:
-    def __init__(self, func, norm):
-        self.func = func
-        self.norm = norm
-    def f(self, arg):
-        return self.func(arg*self.norm)
+# Find the position r_los along the line of sight, on the side of
+# the cloud given by sign, at which the emission at frequency f peaks.
+# The peak is where the Doppler-shifted line center f0 matches f, so
+# this is found by bisection for the root of f - f0(x) on [1e-6, 1].
+# If f - f0 does not change sign on that interval, the line center
+# never reaches f inside the cloud; the emission then peaks where f0
+# comes closest to f, which is found by golden section search. If
+# the cloud has no bulk velocity, or f is further from line center
+# than the line reaches anywhere in the cloud, there is no peak to
+# resolve, and r_los = 1 is returned without searching.
+@njit(cache=True)
+def _find_rlos(f, sign, offset, p):
+    if p.fShift == 0.0 or abs(f-1) > p.fShift + 8*p.fWidth:
+        return 1.0
+    lo = 1e-6
+    hi = 1.0
+    glo = _los_mismatch(lo, f, sign, offset, p)
+    ghi = _los_mismatch(hi, f, sign, offset, p)
+    if glo*ghi > 0:
+        return _closest_los(lo, hi, f, sign, offset, p)
+    for n in range(20):
+        mid = 0.5*(lo+hi)
+        gmid = _los_mismatch(mid, f, sign, offset, p)
+        if glo*gmid > 0:
+            lo = mid
+            glo = gmid
+        else:
+            hi = mid
+    return 0.5*(lo+hi)
+
+# Golden section search on [lo, hi] for the minimum of |f - f0|
+@njit(cache=True)
+def _closest_los(lo, hi, f, sign, offset, p):
+    gr = 0.5*(np.sqrt(5.0)-1.0)
+    a = hi - gr*(hi-lo)
+    b = lo + gr*(hi-lo)
+    ga = abs(_los_mismatch(a, f, sign, offset, p))
+    gb = abs(_los_mismatch(b, f, sign, offset, p))
+    for n in range(30):
+        if ga < gb:
+            hi = b
+            b = a
+            gb = ga
+            a = hi - gr*(hi-lo)
+            ga = abs(_los_mismatch(a, f, sign, offset, p))
+        else:
+            lo = a
+            a = b
+            ga = gb
+            b = lo + gr*(hi-lo)
+            gb = abs(_los_mismatch(b, f, sign, offset, p))
+    return 0.5*(lo+hi)
+
+# f - f0 at distance s from the center on the side given by sign
+@njit(cache=True)
+def _los_mismatch(s, f, sign, offset, p):
+    x = sign*s
+    r = np.sqrt(x**2 + offset**2)
+    return f - (1 - p.beta*_spline_eval(r, p.u_spl)*np.sin(x/(r+small)))
+
+# Break points used when the emission peaks inside the cloud, at
+# r_los, given as multiples of r_los: on each side of the center, the
+# path from |x| = r_los/100 out to the edge of the cloud is done in
+# log |x|, stopping at each break point, and the part between
+# -r_los/100 and r_los/100 is done in x
+_xSegFrac = np.array([0.01, 0.1, 1.0, 1.1])
+
+# Integrate the transfer equation along a pencil beam at frequency
+# f, and return the intensity minus the background ICMB, or nan if
+# the integration fails; the intensity is integrated as the
+# difference from ICMB throughout. If the emission peaks inside the
+# cloud, the path is broken up around the peak, and the parts of it
+# between the peak and the center are done in log |x|, so that the
+# integrator resolves them.
+@njit(cache=True)
+def _pencil_at_v(f, ICMB, sign, offset, p, atol, rtol, mxstep):
+    r_los = _find_rlos(f, sign, offset, p)
+    sMax = np.sqrt(1.0-offset**2)
+    if r_los < 1:
+        xMin = min(_xSegFrac[0]*r_los, sMax)
+        I = _log_side(0.0, -1, r_los, sMax, f, ICMB, offset, p,
+                      atol, rtol, mxstep)
+        if not np.isnan(I):
+            I = _sdirk(I, -xMin, xMin, 0.0, f, ICMB, 0, 0, offset, p,
+                       atol, rtol, mxstep)[0]
+        if not np.isnan(I):
+            I = _log_side(I, 1, r_los, sMax, f, ICMB, offset, p,
+                          atol, rtol, mxstep)
+        return I
+    else:
+        return _sdirk(0.0, -sMax, sMax, 0.0, f, ICMB, 0, 0, offset, p,
+                      atol, rtol, mxstep)[0]
+
+# Integrate in log |x| along one side of the cloud: on the near side
+# (sgn = -1) from the edge in to |x| = r_los/100, and on the far side
+# (sgn = 1) from there back out to the edge. The integration stops at
+# each break point, but the step size is carried across them, so the
+# integrator does not start over from a small step at each one. Break
+# points beyond the end of the path are moved to it.
+@njit(cache=True)
+def _log_side(I, sgn, r_los, sMax, f, Ibg, offset, p,
+              atol, rtol, mxstep):
+    n = _xSegFrac.size
+    hstep = 0.0
+    for j in range(n):
+        if sgn < 0:
+            if j == 0:
+                x0 = sMax
+            else:
+                x0 = min(_xSegFrac[n-j]*r_los, sMax)
+            x1 = min(_xSegFrac[n-1-j]*r_los, sMax)
+        else:
+            x0 = min(_xSegFrac[j]*r_los, sMax)
+            if j == n-1:
+                x1 = sMax
+            else:
+                x1 = min(_xSegFrac[j+1]*r_los, sMax)
+        if x0 == x1:
+            continue
+        I, hstep = _sdirk(I, np.log(x0), np.log(x1), hstep, f, Ibg, 1,
+                          sgn, offset, p, atol, rtol, mxstep)
+        if np.isnan(I):
+            break
+    return I
+
+# Pencil beam intensities for a set of frequencies, done in parallel
+@njit(cache=True, parallel=True)
+def _pencil_grid(f, ICMB, sign, offset, p, atol, rtol, mxstep):
+    iOut = np.zeros(f.size)
+    for i in prange(f.size):
+        iOut[i] = _pencil_at_v(f[i], ICMB[i], sign[i], offset, p,
+                               atol, rtol, mxstep)
+    return iOut
+
+# Beam-averaged intensities for a set of frequencies: the pencil
+# beams at offsets rNode are done in parallel, then summed with
+# weights wNode
+@njit(cache=True, parallel=True)
+def _beam_grid(f, ICMB, sign, rNode, wNode, p, atol, rtol, mxstep):
+    nr = rNode.size
+    iPencil = np.zeros(f.size*nr)
+    for k in prange(f.size*nr):
+        i = k // nr
+        iPencil[k] = _pencil_at_v(f[i], ICMB[i], sign[i], rNode[k % nr],
+                                  p, atol, rtol, mxstep)
+    return iPencil.reshape((f.size, nr)) @ wNode
+
+# Convert normalized intensities to brightness temperatures in a
+# single pass; TB has the sign of the intensity, and is 0 where the
+# intensity is 0
+@njit(cache=True)
+def _brightnessTemp(iOut, hnu_k, A, I0):
+    TB = np.empty(iOut.size)
+    for i in range(iOut.size):
+        if iOut[i] == 0.0:
+            TB[i] = 0.0
+        else:
+            TB[i] = np.sign(iOut[i]) * hnu_k / \
+                np.log(1.0 + A/(abs(iOut[i])*I0+small))
+    return TB
+
+# Return a _transferEqn for the given cloud, reusing one built by an
+# earlier call if there is one. The arguments are hashed as they are,
+# so floats match by value and callables and emdat by identity;
+# the cache holds references to them, so identities cannot be reused
+# while an entry is alive. If any argument is unhashable, the
+# _transferEqn is built without caching. Hashability is checked
+# before building, so that a TypeError raised by a profile function
+# is passed on rather than taken for an unhashable argument.
+def _getTransferEqn(*args):
+    try:
+        hash(args)
+    except TypeError:
+        return _transferEqn(*args)
+    return _cachedTransferEqn(*args)
+
+@lru_cache(maxsize=16)
+def _cachedTransferEqn(*args):
+    return _transferEqn(*args)
 
-# Dummy function that just returns 1.0
-def _unity(r):
-    return 1.0
+
+########################################################################
+# Helper to set up a profile for the transfer equation. It returns the
+# normalization of the profile, which is its value at the cloud edge,
+# and a table of the profile divided by that normalization at the
+# normalized radii r. A profile given as a float is uniform. The table
+# is a plain array, so that it can be handed to compiled code.
+########################################################################
+def _sampleProf(prof, r):
+    if isinstance(prof, float):
+        return prof, np.ones(r.shape)
+    norm = prof(1.0)
+    return norm, np.array([prof(rr) for rr in r]) / norm
+
+
+########################################################################
+# This is the RHS of the transfer equation, written as free functions
+# of plain numbers so that it can be compiled by numba. The emission
+# and absorption coefficients and the profiles T, u, sigma are passed
+# in already evaluated at the normalized radius r of position x. I and
+# f may be floats, or arrays holding one entry per velocity.
+########################################################################
+
+# Line shape function: a Gaussian in frequency of variance sigmaf^2,
+# centered on the Doppler-shifted line center f0. This is written in
+# terms of 1/(2 sigmaf^2), so that it takes a single square root and
+# a single exponential.
+@njit(cache=True, fastmath=True)
+def _line_shape(x, r, f, T_r, u_r, sigma_r, betas, betaNT, beta):
+    var = betas*betas*T_r + betaNT*betaNT*sigma_r*sigma_r
+    inv2var = 0.5/var
+    norm = np.sqrt(inv2var/np.pi)
+    f0 = 1 - beta*u_r*np.sin(x/(r+small))
+    df = f - f0
+    return norm * np.exp(-df*df*inv2var)
+
+# The RHS proper. Everything that depends on position only through
+# the temperature and density -- the Boltzmann factors and the
+# partition function -- is folded into the emission and absorption
+# coefficients j_r and k_r, which _transferEqn tabulates once, so
+# that no exponentials of the temperature are needed here.
+@njit(cache=True, fastmath=True)
+def _rhs_core(I, x, r, f, j_r, k_r, T_r, u_r, sigma_r,
+              betas, betaNT, beta):
+
+    # Compute line shape function
+    phif = _line_shape(x, r, f, T_r, u_r, sigma_r, betas, betaNT, beta)
+
+    # Return RHS
+    return (j_r - k_r*I) * phif
+
+# The RHS is linear in I, so its derivative with respect to I is just
+# the coefficient of I, and does not depend on I
+@njit(cache=True, fastmath=True)
+def _jac_core(x, r, f, j_r, k_r, T_r, u_r, sigma_r,
+              betas, betaNT, beta):
+    phif = _line_shape(x, r, f, T_r, u_r, sigma_r, betas, betaNT, beta)
+    return -k_r * phif
+
+
+########################################################################
+# Compiled versions of the RHS and of the integrator used for pencil
+# beams. These cannot call the python profile functions, so they work
+# from tables that _transferEqn builds on a uniform grid in normalized
+# radius. The tables hold the coefficients of a monotone (PCHIP)
+# cubic through the sampled profiles, rather than the samples
+# themselves: linear interpolation would give the RHS a kink at every
+# grid point, which forces the ODE solvers to take tiny steps at tight
+# tolerances, while an ordinary cubic spline overshoots at steps in
+# the profiles, and can make the temperature or the emission negative
+# there.
+# The spline tables and the scalar constants are passed around
+# together as a _teParams tuple; fShift and fWidth are the largest
+# Doppler shift of the line center and the largest line width in the
+# cloud, in normalized frequency.
+########################################################################
+_teParams = namedtuple('_teParams',
+                       ['betas', 'betaNT', 'beta', 'j_spl', 'k_spl',
+                        'T_spl', 'u_spl', 'sigma_spl', 'fShift',
+                        'fWidth'])
+
+# Build the spline table for samples y on a uniform grid r in [0, 1];
+# row k holds the coefficient of (r - r_i)**(3-k) on interval i. The
+# interpolant stays between the samples on either side of each
+# interval, so it is positive wherever they are.
+def _spline_tab(r, y):
+    return PchipInterpolator(r, y).c
+
+# Evaluate a spline table at r; the grid is uniform, so the interval
+# is found directly rather than by searching. Values outside [0, 1]
+# are clamped to the ends of the table.
+@njit(cache=True)
+def _spline_eval(r, spl):
+    nint = spl.shape[1]
+    r = min(max(r, 0.0), 1.0)
+    i = min(int(r*nint), nint-1)
+    t = r - i/nint
+    return ((spl[0,i]*t + spl[1,i])*t + spl[2,i])*t + spl[3,i]
+
+# RHS at position x, with the profiles evaluated from the tables; I
+# is the intensity above a background Ibg
+@njit(cache=True)
+def _rhs_tab(I, x, f, Ibg, offset, p):
+    r = np.sqrt(x**2 + offset**2)
+    return _rhs_core(Ibg + I, x, r, f,
+                     _spline_eval(r, p.j_spl),
+                     _spline_eval(r, p.k_spl),
+                     _spline_eval(r, p.T_spl),
+                     _spline_eval(r, p.u_spl),
+                     _spline_eval(r, p.sigma_spl),
+                     p.betas, p.betaNT, p.beta)
+
+# Jacobian of the RHS, likewise using the tables
+@njit(cache=True)
+def _jac_tab(x, f, offset, p):
+    r = np.sqrt(x**2 + offset**2)
+    return _jac_core(x, r, f,
+                     _spline_eval(r, p.j_spl),
+                     _spline_eval(r, p.k_spl),
+                     _spline_eval(r, p.T_spl),
+                     _spline_eval(r, p.u_spl),
+                     _spline_eval(r, p.sigma_spl),
+                     p.betas, p.betaNT, p.beta)
+
+# RHS on a segment of the path; for logarithmic segments the
+# independent variable is t = log(sgn*x), so dI/dt = sgn * x * dI/dx
+@njit(cache=True)
+def _rhs_seg(I, t, f, Ibg, logscale, sgn, offset, p):
+    if logscale:
+        x = np.exp(t)
+        return sgn * x * _rhs_tab(I, sgn*x, f, Ibg, offset, p)
+    else:
+        return _rhs_tab(I, t, f, Ibg, offset, p)
+
+# The RHS at position x written as a - b*I, with the profiles
+# evaluated from the tables; I is the intensity above a background Ibg
+@njit(cache=True)
+def _lin_tab(x, f, Ibg, offset, p):
+    r = np.sqrt(x**2 + offset**2)
+    j_r = _spline_eval(r, p.j_spl)
+    k_r = _spline_eval(r, p.k_spl)
+    phif = _line_shape(x, r, f, _spline_eval(r, p.T_spl),
+                       _spline_eval(r, p.u_spl),
+                       _spline_eval(r, p.sigma_spl),
+                       p.betas, p.betaNT, p.beta)
+    return (j_r - k_r*Ibg) * phif, k_r * phif
+
+# The same on a segment of the path, as for _rhs_seg
+@njit(cache=True)
+def _lin_seg(t, f, Ibg, logscale, sgn, offset, p):
+    if logscale:
+        x = sgn * np.exp(t)
+        a, b = _lin_tab(x, f, Ibg, offset, p)
+        return x * a, x * b
+    else:
+        return _lin_tab(t, f, Ibg, offset, p)
+
+# Adaptive integration of a single segment from t0 to t1, starting
+# with step hstep, or with a step of 1% of the segment if hstep is 0;
+# a step carried over from a previous segment is limited to 10% of
+# this one, so that it cannot jump over a narrow peak in the emission.
+# The method is the L-stable, stiffly accurate SDIRK 4(3) scheme of
+# Hairer & Wanner (Solving ODEs II, Table 6.5), with gamma = 1/4. An
+# explicit solver is limited to steps of about one optical depth, and
+# does not finish within mxstep steps through an optically thick
+# cloud; an L-stable one can step across optically thick stretches
+# where the intensity has saturated. Since the RHS is linear in I, the
+# implicit equation for each stage is solved exactly, and each stage
+# costs one evaluation of the tables, as an explicit stage would. I is
+# the intensity above the background Ibg, so that the error tolerances
+# apply to the line rather than to the background. Returns I at t1
+# and the step size to continue with. If the integration does not
+# reach t1 in mxstep steps, the intensity returned is nan rather than
+# an exception raised, since this also runs on GPUs, where exceptions
+# are not available; callers check for it.
+@njit(cache=True)
+def _sdirk(I, t0, t1, hstep, f, Ibg, logscale, sgn, offset, p,
+           atol, rtol, mxstep):
+
+    # Initial step; the controller adjusts it from here
+    t = t0
+    if hstep == 0.0:
+        hstep = 0.01*(t1-t0)
+    else:
+        hstep = math.copysign(min(abs(hstep), 0.1*abs(t1-t0)), t1-t0)
+
+    for n in range(mxstep):
+
+        # Don't step past the end of the segment
+        h = hstep
+        if (t + h - t1)*(t1 - t0) > 0:
+            h = t1 - t
+
+        # Take a trial step; stage i solves
+        # k_i = a_i - b_i*(I + h*sum_j A_ij k_j + h*k_i/4)
+        a1, b1 = _lin_seg(t + h/4, f, Ibg, logscale, sgn, offset, p)
+        k1 = (a1 - b1*I) / (1 + h*b1/4)
+        a2, b2 = _lin_seg(t + 3*h/4, f, Ibg, logscale, sgn, offset, p)
+        k2 = (a2 - b2*(I + h*(k1/2))) / (1 + h*b2/4)
+        a3, b3 = _lin_seg(t + 11*h/20, f, Ibg, logscale, sgn, offset, p)
+        k3 = (a3 - b3*(I + h*(17*k1/50 - k2/25))) / (1 + h*b3/4)
+        a4, b4 = _lin_seg(t + h/2, f, Ibg, logscale, sgn, offset, p)
+        k4 = (a4 - b4*(I + h*(371*k1/1360 - 137*k2/2720 +
+                              15*k3/544))) / (1 + h*b4/4)
+        a5, b5 = _lin_seg(t + h, f, Ibg, logscale, sgn, offset, p)
+        k5 = (a5 - b5*(I + h*(25*k1/24 - 49*k2/48 + 125*k3/16 -
+                              85*k4/12))) / (1 + h*b5/4)
+        Inew = I + h*(25*k1/24 - 49*k2/48 + 125*k3/16 - 85*k4/12 +
+                      k5/4)
+
+        # Error estimate from the embedded 3rd order solution; it is
+        # damped by the same factor as the stages, so that it stays
+        # small where the solution has relaxed to the source function
+        err = h*(-3*k1/16 - 27*k2/32 + 25*k3/32 + k5/4) / (1 + h*b5/4)
+        scale = atol + rtol*max(abs(I), abs(Inew))
+        errnorm = abs(err)/scale
+
+        # Accept or reject the step, and choose the next step size
+        if errnorm <= 1.0:
+            t = t + h
+            I = Inew
+            if t == t1:
+                return I, hstep
+            if errnorm == 0.0:
+                hstep = 5.0*h
+            else:
+                hstep = h*min(5.0, max(0.2, 0.9*errnorm**-0.25))
+        else:
+            hstep = h*max(0.2, 0.9*errnorm**-0.25)
+
+    return np.nan, hstep
+
+
+########################################################################
+# GPU version of the pencil beam integrator. The compiled functions
+# above use nothing that a GPU cannot run, so rather than keep a second
+# copy of them, their python sources are compiled again as CUDA device
+# functions, with the calls each makes to the others pointed at the
+# device versions. Everything on the GPU is scalar, so numpy is
+# replaced by the math module there, which the CUDA target supports
+# fully. This is done on first use, so that numba's CUDA support is
+# only needed if a GPU is asked for.
+########################################################################
+_cudaThreads = 128
+
+# numba's CUDA module, which _cudaKernel imports on first use and
+# binds in the functions it compiles
+cuda = None
+
+# Functions compiled as CUDA device functions; each must come after
+# the ones it calls, since it is bound to the device versions
+# compiled before it
+_cudaDevice = (_spline_eval, _line_shape, _lin_tab, _lin_seg, _sdirk,
+               _los_mismatch, _closest_los, _find_rlos, _log_side,
+               _pencil_at_v)
+
+# Kernel run by each GPU thread, which does one pair of frequency and
+# offset; _cudaKernel compiles it with cuda and the device version of
+# _pencil_at_v supplied
+def _cudaPencil(iPencil, f, ICMB, sign, offset, p, atol, rtol, mxstep):
+    k = cuda.grid(1)
+    if k < iPencil.size:
+        i = k // offset.size
+        iPencil[k] = _pencil_at_v(f[i], ICMB[i], sign[i],
+                                  offset[k % offset.size], p,
+                                  atol, rtol, mxstep)
+
+# Copy of the python function py whose global names are looked up in
+# glb first
+def _rebind(py, glb):
+    return types.FunctionType(py.__code__, dict(py.__globals__, **glb),
+                              py.__name__, py.__defaults__)
+
+@lru_cache(maxsize=None)
+def _cudaKernel():
+    from numba import cuda
+    if not cuda.is_available():
+        raise despoticError(
+            "device 'cuda' requested, but no CUDA GPU is available")
+    dev = {'cuda': cuda, 'np': math}
+    for fn in _cudaDevice:
+        dev[fn.__name__] = cuda.jit(device=True)(
+            _rebind(fn.py_func, dev))
+    return cuda, cuda.jit(_rebind(_cudaPencil, dev))
+
+# Pencil beam intensities on the GPU for every pair of frequency f
+# and offset, returned as an array of shape (f.size, offset.size)
+def _cuda_grid(f, ICMB, sign, offset, p, atol, rtol, mxstep):
+    cuda, kernel = _cudaKernel()
+    pDev = _teParams(*[cuda.to_device(x) if isinstance(x, np.ndarray)
+                       else x for x in p])
+    iPencil = cuda.device_array(f.size*offset.size)
+    nBlock = (iPencil.size + _cudaThreads - 1) // _cudaThreads
+    kernel[nBlock, _cudaThreads](
+        iPencil, cuda.to_device(f), cuda.to_device(ICMB),
+        cuda.to_device(sign), cuda.to_device(offset), pDev,
+        atol, rtol, mxstep)
+    return iPencil.copy_to_host().reshape((f.size, offset.size))
 
 
 class _transferEqn:
 
-    # Function to return the RHS of the transfer equation
-
-    def rhs(self, I, x, f):
-        v=(c*(f-1))
-        # Compute normalized radius
-        r = np.sqrt(x**2 + self.offset**2)
-      
-        # Compute line shape function
-        sigmaf = np.sqrt(self.betas**2*self.T.f(r) + \
-                          self.betaNT**2*self.sigma.f(r)**2)
-        f0 = 1 - self.beta*self.u.f(r)*np.sin(x/(r+small))
-        phif = 1.0/np.sqrt(2*np.pi*sigmaf**2) * \
-            np.exp(-(f-f0)**2/(2*sigmaf**2))
-
-        # Return RHS
-        rhs = self.d.f(r) * (self.prefac/self.Z.f(self.T.f(r))) * \
-            (np.exp(-self.Theta/self.T.f(r)) - self.tau0* \
-                 (1.0-np.exp(-self.Theta/self.T.f(r)))*I) * phif
-        return rhs
-
-    def rhs_log(self, I, logx, te, f, sgn):
-        return sgn*te.rhs(I, sgn*np.exp(logx), f)*((np.exp(logx)**2)/(np.sqrt((np.exp(logx))**2+(self.offset)**2)))       
-
-    def rhs_ode(self, x, I, f):
-        v=(c*(f-1))
-        # Compute normalized radius
-        r = np.sqrt(x**2 + self.offset**2)
-      
-        # Compute line shape function
-        sigmaf = np.sqrt(self.betas**2*self.T.f(r) + \
-                          self.betaNT**2*self.sigma.f(r)**2)
-        f0 = 1 - self.beta*self.u.f(r)*np.sin(x/(r+small))
-        phif = 1.0/np.sqrt(2*np.pi*sigmaf**2) * \
-            np.exp(-(f-f0)**2/(2*sigmaf**2))
-
-        # Return RHS
-        rhs = self.d.f(r) * (self.prefac/self.Z.f(self.T.f(r))) * \
-            (np.exp(-self.Theta/self.T.f(r)) - self.tau0* \
-                 (1.0-np.exp(-self.Theta/self.T.f(r)))*I) * phif
-        return rhs
-
-    def rhs_log_ode(self, logx, I, te, f, sgn):
-        return sgn*te.rhs(I, sgn*np.exp(logx), f)*((np.exp(logx)**2)/(np.sqrt((np.exp(logx))**2+(self.offset)**2)))
-
-    def rhs1(self, x, I, f):
-
-        # Compute normalized radius
-        r = np.sqrt(x**2 + self.offset**2)
-
-        # Compute line shape function
-        sigmaf = np.sqrt(self.betas**2*self.T.f(r) + \
-                          self.betaNT**2*self.sigma.f(r)**2)
-        f0 = 1 - self.beta*self.u.f(r)*np.sin(x/(r+small))
-        phif = 1.0/np.sqrt(2*np.pi*sigmaf**2) * \
-            np.exp(-(f-f0)**2/(2*sigmaf**2))
-
-        # Return RHS
-        return self.d.f(r) * (self.prefac/self.Z.f(self.T.f(r))) * \
-            (np.exp(-self.Theta/self.T.f(r)) - self.tau0* \
-                 (1.0-np.exp(-self.Theta/self.T.f(r)))*I) * phif
+    # Function to return the RHS of the transfer equation for the
+    # intensity I above a background Ibg; I, f and Ibg may be scalars,
+    # or arrays holding one entry per velocity. The profiles are
+    # looked up in the radial tables built by __init__, so this is a
+    # thin wrapper around compiled code.
+    def rhs(self, I, x, f, Ibg=0.0):
+        return _rhs_tab(I, x, f, Ibg, self.offset, self.params)
+
+    # Function to return the Jacobian of the RHS with respect to I.
+    # Different velocities do not couple, so the Jacobian is diagonal;
+    # it is returned in the banded form odeint expects for ml = mu =
+    # 0, i.e. as a single row holding the diagonal.
+    def jac(self, I, x, f, Ibg=0.0):
+        return np.atleast_2d(_jac_tab(x, f, self.offset, self.params))
+
+    # The same RHS with the arguments in the order (x, I) expected by
+    # scipy.integrate.ode
+    def rhs_ode(self, x, I, f, Ibg=0.0):
+        return _rhs_tab(I, x, f, Ibg, self.offset, self.params)
+
+    # RHS in terms of t = log(sgn*x), for integrating on one side of
+    # the cloud in log |x|; dI/dt = sgn * x * dI/dx
+    def rhs_log(self, I, logx, f, sgn, Ibg=0.0):
+        return _rhs_seg(I, logx, f, Ibg, True, sgn, self.offset,
+                        self.params)
 
 
     # Initialization function
     def __init__(self, emdat, u, l, R, denProf, TProf, vProf, \
                      sigmaProf, offset):
 
-        # Get normalizations, and set up function pointers
-        if isinstance(denProf, float):
-            d0 = denProf
-            self.d = _normFunc(_unity, 1.0)
-        else:
-            d0 = denProf(1.0)
-            self.d = _normFunc(denProf, d0)
-        if isinstance(TProf, float):
-            T0 = TProf
-            self.T = _normFunc(_unity, 1.0)
-        else:
-            T0 = TProf(1.0)
-            self.T = _normFunc(TProf, T0)
-        if isinstance(vProf, float):
-            self.v0 = vProf
-            self.u = _normFunc(_unity, 1.0)
-        else:
-            self.v0 = vProf(1.0)
-            self.u = _normFunc(vProf, self.v0)
-        if isinstance(sigmaProf, float):
-            sigma0 = sigmaProf
-            self.sigma = _normFunc(_unity, 1.0)
-        else:
-            sigma0 = sigmaProf(1.0)
-            self.sigma = _normFunc(sigmaProf, sigma0)
+        # Get normalizations, and tabulate the normalized profiles on
+        # a uniform grid in normalized radius; the RHS interpolates in
+        # these tables rather than calling the profile functions, so
+        # that each profile is evaluated only here
+        self._r_grid = np.linspace(0.0, 1.0, 4096)
+        d0, self._d_tab = _sampleProf(denProf, self._r_grid)
+        T0, self._T_tab = _sampleProf(TProf, self._r_grid)
+        self.v0, self._u_tab = _sampleProf(vProf, self._r_grid)
+        sigma0, self._sigma_tab = _sampleProf(sigmaProf, self._r_grid)
 
         # Compute derived quantities that we need to store
         cs0 = np.sqrt(kB*T0/(emdat.molWgt*mH))
@@ -442,6 +930,55 @@ class _transferEqn:
         self.I0 = emdat.EinsteinA[u,l] * d0 * h * R
         self.prefac = d0 * emdat.levWgt[u] * np.exp(-emdat.levTemp[l]/T0) \
             / (4*np.pi)
-        self.Z = _normFunc2(emdat.partFunc, T0)
         self.offset = offset
         self.sigmaTot = np.sqrt(cs0**2+self.v0**2)
+
+        # Tabulate the partition function. It is only evaluated at the
+        # distinct temperatures in the table, so for a uniform
+        # temperature it is computed just once.
+        Tuniq, Tidx = np.unique(self._T_tab, return_inverse=True)
+        self._Z_tab = np.array([emdat.partFunc(T*T0)
+                                for T in Tuniq])[Tidx]
+
+        # From these, tabulate the emission and absorption
+        # coefficients; dividing by the partition function and taking
+        # the Boltzmann factors here keeps all the exponentials of T
+        # out of the RHS
+        coef = self._d_tab * self.prefac / self._Z_tab
+        self._j_tab = coef * np.exp(-self.Theta/self._T_tab)
+        self._k_tab = -coef * self.tau0 * np.expm1(-self.Theta/self._T_tab)
+
+        # Largest step the vectorized solver may take along the line
+        # of sight. The emission at any one velocity is confined to
+        # where the line center f0 = 1 - beta*u(r)*x/r is within a
+        # line width of it, so the step is limited to the narrowest
+        # line width in the cloud divided by the steepest gradient of
+        # f0 along the path; otherwise the solver can step over the
+        # emission peak entirely. The step is not allowed below 1e-3,
+        # so that very steep velocity profiles do not exhaust mxstep,
+        # and is 0, meaning no limit, if f0 is the same everywhere.
+        sMax = np.sqrt(1.0-offset**2)
+        x = np.linspace(-sMax, sMax, 4096)
+        r = np.sqrt(x**2 + offset**2)
+        u_r = np.interp(r, self._r_grid, self._u_tab)
+        du_r = np.interp(r, self._r_grid,
+                         np.gradient(self._u_tab, self._r_grid))
+        gradf0 = abs(self.beta) * np.max(np.abs(
+            du_r*x**2/(r**2+small) + u_r*offset**2/(r**3+small)))
+        wMin = np.sqrt(np.min(self.betas**2*self._T_tab +
+                              self.betaNT**2*self._sigma_tab**2))
+        if gradf0 > 0:
+            self.hmax = max(wMin/gradf0, 1e-3)
+        else:
+            self.hmax = 0.0
+
+        self.params = _teParams(
+            self.betas, self.betaNT, self.beta,
+            _spline_tab(self._r_grid, self._j_tab),
+            _spline_tab(self._r_grid, self._k_tab),
+            _spline_tab(self._r_grid, self._T_tab),
+            _spline_tab(self._r_grid, self._u_tab),
+            _spline_tab(self._r_grid, self._sigma_tab),
+            abs(self.beta)*np.max(np.abs(self._u_tab)),
+            np.sqrt(np.max(self.betas**2*self._T_tab +
+                           self.betaNT**2*self._sigma_tab**2)))
@@ -0,0 +1,280 @@
+"""
+Regression tests for lineProfLTE. The module is meant to live inside
+DESPOTIC, and imports emitterData and despoticError from its package,
+so the tests load it from a stand-in package holding just those two
+names, and use a small CO-like emitter in place of DESPOTIC's.
+"""
+
+import importlib
+import inspect
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+from scipy.integrate import quad
+
+REPO = Path(__file__).resolve().parents[1]
+
+
+class _Emitter:
+    """Four-level rotor with CO-like frequencies and A values."""
+
+    def __init__(self):
+        n = 4
+        self.molWgt = 28.0
+        self.freq = np.zeros((n, n))
+        self.EinsteinA = np.zeros((n, n))
+        for j in range(1, n):
+            self.freq[j, j-1] = 115.271e9*j
+            self.EinsteinA[j, j-1] = 7.2e-8*j**3
+        self.levWgt = 2*np.arange(n) + 1.0
+        self.levTemp = np.array([0.0, 5.53, 16.6, 33.19])
+
+    def partFunc(self, T):
+        return np.sum(self.levWgt*np.exp(-self.levTemp/T))
+
+
+@pytest.fixture(scope='module')
+def lp(tmp_path_factory):
+    pkg = tmp_path_factory.mktemp('src') / 'despotic_stub'
+    pkg.mkdir()
+    (pkg / '__init__.py').write_text('')
+    (pkg / 'emitterData.py').write_text('class emitterData:\n    pass\n')
+    (pkg / 'despoticError.py').write_text(
+        'class despoticError(Exception):\n    pass\n')
+    shutil.copy(REPO / 'lineProfLTE.py', pkg / 'lineProfLTE.py')
+    sys.path.insert(0, str(pkg.parent))
+    try:
+        yield importlib.import_module('despotic_stub.lineProfLTE')
+    finally:
+        sys.path.remove(str(pkg.parent))
+
+
+@pytest.fixture(scope='module')
+def em():
+    return _Emitter()
+
+
+R = 3e17
+
+# Centrally condensed, collapsing cloud whose emission at any one
+# velocity comes from a narrow shell
+collapse = dict(denProf=lambda r: 1.0/(r**2+0.01), TProf=10.0,
+                vProf=lambda r: -3e5*r)
+
+
+@pytest.mark.parametrize('nOut', [3, 5])
+def test_sparse_velocities(lp, em, nOut):
+    # The vectorized solver must not step over the emission peak
+    # when there are few velocities to integrate
+    TB, vOut = lp.lineProfLTE(em, 1, 0, R, vLim=[-2.8e5, 2.8e5],
+                              nOut=nOut, **collapse)
+    assert np.all(TB[np.abs(vOut) < 2e5] > 9.0)
+
+
+@pytest.mark.filterwarnings('ignore::scipy.integrate.ODEintWarning')
+@pytest.mark.parametrize('tol', [dict(mxstep=20),
+                                 dict(rtol=1e-11, atol=1e-15)])
+def test_odeint_failure(lp, em, tol):
+    # odeint returns whatever it had reached when it fails, which
+    # must not come back as a spectrum
+    with pytest.raises(lp.despoticError):
+        lp.lineProfLTE(em, 1, 0, R, vLim=[-2e5, 2e5], nOut=9,
+                       **tol, **collapse)
+
+
+def test_narrow_beam(lp, em):
+    # The quadrature nodes must resolve a beam much narrower than
+    # the cloud; compare with adaptive quadrature over the beam
+    bd, v = 0.02, 0.0
+    TB, _ = lp.lineProfLTE(em, 1, 0, R, vOut=np.array([v]), beamdisp=bd,
+                           **collapse)
+    te = lp._transferEqn(em, 1, 0, R, collapse['denProf'],
+                         collapse['TProf'], collapse['vProf'], 0.0, 0.0)
+    I = quad(lambda r: r*np.exp(-r**2/(2*bd**2))/bd**2 *
+             lp.LineProfLTE_pencil(v, te, offset=r), 0, 8*bd,
+             epsabs=1e-14, epsrel=1e-10, limit=200)[0]
+    hnu_k = lp.h*te.freq/lp.kB
+    TBref = hnu_k/np.log(1+2*lp.h*te.freq**3/(lp.c**2*I*te.I0))
+    assert np.abs(TB[0]-TBref) < 1e-3
+
+
+def test_line_wings(lp, em):
+    # The tolerances apply to the line above the CMB, so the two
+    # integrators agree to well below 1e-3 K in the wings as well
+    TB, _ = lp.lineProfLTE(em, 1, 0, R, vLim=[-2.2e5, 2.2e5], nOut=23,
+                           **collapse)
+    TBrk, _ = lp.lineProfLTE(em, 1, 0, R, vLim=[-2.2e5, 2.2e5], nOut=23,
+                             integrator='rk45', **collapse)
+    assert np.min(TB) > 0.3
+    np.testing.assert_allclose(TB, TBrk, rtol=0, atol=1e-3)
+
+
+@pytest.mark.parametrize('prof', [
+    dict(denProf=1.0, TProf=lambda r: 300.0 if r < 0.3 else 10.0),
+    dict(denProf=lambda r: 1000.0 if r < 0.3 else 1.0, TProf=10.0)])
+def test_step_profiles(lp, em, prof):
+    # The profile tables must not overshoot at a step, where they
+    # would make the temperature or the emission negative
+    te = lp._transferEqn(em, 1, 0, R, prof['denProf'], prof['TProf'],
+                         -3e4, 0.0, 0.0)
+    r = np.linspace(0, 1, 20001)
+    for spl in [te.params.T_spl, te.params.j_spl, te.params.k_spl]:
+        assert min(lp._spline_eval(rr, spl) for rr in r) >= 0
+    TB, _ = lp.lineProfLTE(em, 1, 0, R, vLim=[-2e5, 2e5], nOut=9,
+                           vProf=-3e4, **prof)
+    assert np.all(np.isfinite(TB))
+
+
+@pytest.mark.parametrize('prof', [
+    dict(denProf=100.0, TProf=15.0),
+    dict(denProf=300.0, TProf=15.0, vProf=lambda r: -3e5*r)])
+def test_thick_line(lp, em, prof):
+    # The compiled integrator must get through optically thick lines,
+    # for pencil beams and for Gaussian beams alike
+    vLim = [-2e5, 2e5]
+    TB, _ = lp.lineProfLTE(em, 1, 0, R, vLim=vLim, nOut=9, **prof)
+    TBrk, _ = lp.lineProfLTE(em, 1, 0, R, vLim=vLim, nOut=9,
+                             integrator='rk45', **prof)
+    np.testing.assert_allclose(TBrk, TB, rtol=0, atol=1e-3)
+    TBbeam, _ = lp.lineProfLTE(em, 1, 0, R, vLim=vLim, nOut=9,
+                               beamdisp=0.3, **prof)
+    assert np.all(np.isfinite(TBbeam))
+    assert np.max(TBbeam) <= np.max(TB) + 1e-3
+
+
+def test_cuda_device_functions(lp):
+    # The GPU build rebinds np to the math module in the shared
+    # kernels, so every np name they use must exist there
+    for fn in lp._cudaDevice:
+        for name in re.findall(r'\bnp\.(\w+)', inspect.getsource(fn)):
+            assert hasattr(math, name), fn.__name__+' uses np.'+name
+
+
+def test_cuda_simulator(lp):
+    # Run the GPU path on numba's CUDA simulator, which must be
+    # switched on before numba is imported, so in a fresh interpreter
+    script = """
+import sys
+sys.path[:0] = sys.argv[1:]
+import numpy as np
+from despotic_stub.lineProfLTE import lineProfLTE
+from test_lineProfLTE import _Emitter, R, collapse
+em = _Emitter()
+for kw in [dict(integrator='rk45', nOut=5), dict(beamdisp=0.3, nOut=3)]:
+    TB, _ = lineProfLTE(em, 1, 0, R, vLim=[-2e5, 2e5], **kw, **collapse)
+    TBgpu, _ = lineProfLTE(em, 1, 0, R, vLim=[-2e5, 2e5], device='cuda',
+                           **kw, **collapse)
+    np.testing.assert_allclose(TBgpu, TB, rtol=0, atol=1e-6)
+"""
+    pkg = Path(lp.__file__).parents[1]
+    env = dict(os.environ, NUMBA_ENABLE_CUDASIM='1')
+    res = subprocess.run([sys.executable, '-c', script, str(pkg),
+                          str(Path(__file__).parent)],
+                         env=env, capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+
+
+def test_profile_type_error(lp, em):
+    # A TypeError from a profile must reach the caller after one
+    # attempt, not be taken for an unhashable argument and retried
+    calls = []
+
+    def TProf(r):
+        calls.append(r)
+        raise TypeError('bad profile')
+    with pytest.raises(TypeError, match='bad profile'):
+        lp.lineProfLTE(em, 1, 0, R, denProf=1.0, TProf=TProf)
+    assert len(calls) == 1
+
+
+def _te(lp, em, vProf):
+    return lp._transferEqn(em, 1, 0, R, 1.0, 10.0, vProf, 0.0, 0.0)
+
+
+@pytest.mark.parametrize('sign', [-1.0, 1.0])
+def test_find_rlos_bisection(lp, em, sign):
+    # Where the line center reaches f inside the cloud, r_los is the
+    # root of the mismatch
+    p = _te(lp, em, lambda r: -3e5*r).params
+    f = 1 - lp._los_mismatch(0.4, 1.0, sign, 0.0, p)
+    r_los = lp._find_rlos(f, sign, 0.0, p)
+    assert abs(r_los - 0.4) < 1e-6
+
+
+def test_find_rlos_closest(lp, em):
+    # Where it does not, r_los is where the line center comes
+    # closest to f; here the velocity peaks inside the cloud
+    p = _te(lp, em, lambda r: -3e5*r*np.exp(-((r-0.5)/0.2)**2)).params
+    s = np.linspace(1e-6, 1, 100001)
+    for sign in [-1.0, 1.0]:
+        f0 = 1 - np.array([lp._los_mismatch(ss, 1.0, sign, 0.0, p)
+                           for ss in s])
+        f = f0[np.argmax(np.abs(f0-1))] + \
+            np.sign(f0[np.argmax(np.abs(f0-1))]-1)*2*p.fWidth
+        assert np.all(np.sign(f-f0) == np.sign(f-f0[0]))
+        r_los = lp._find_rlos(f, sign, 0.0, p)
+        assert abs(r_los - s[np.argmin(np.abs(f-f0))]) < 1e-3
+
+
+def test_find_rlos_no_peak(lp, em):
+    # With no bulk velocity, or beyond the reach of the line, there
+    # is nothing to search for
+    p = _te(lp, em, 0.0).params
+    assert p.fShift == 0.0
+    assert lp._find_rlos(1.0, 1.0, 0.0, p) == 1.0
+    p = _te(lp, em, lambda r: -3e5*r).params
+    for sign in [-1.0, 1.0]:
+        f = 1 + sign*(p.fShift + 10*p.fWidth)
+        assert lp._find_rlos(f, sign, 0.0, p) == 1.0
+        assert lp._find_rlos(f, -sign, 0.0, p) == 1.0
+
+
+def test_brightness_temp(lp):
+    # TB has the sign of the intensity, and is 0 where it is 0
+    TB = lp._brightnessTemp(np.array([-1e-3, 0.0, 1e-3]), 5.5, 1.0, 1.0)
+    assert TB[1] == 0.0
+    assert TB[2] > 0
+    assert TB[0] == -TB[2]
+
+
+def test_transfer_eqn_cache(lp, em):
+    # A repeated cloud reuses its _transferEqn; a changed one does not
+    lp._cachedTransferEqn.cache_clear()
+    for TProf in [10.0, 10.0, 20.0]:
+        lp.lineProfLTE(em, 1, 0, R, denProf=1.0, TProf=TProf, nOut=3)
+    info = lp._cachedTransferEqn.cache_info()
+    assert (info.hits, info.misses) == (1, 2)
+
+
+@pytest.mark.parametrize('grid, n', [(dict(vLim=[-1e5, 1e5], nOut=7), 7),
+                                     (dict(dv=1e4, nOut=6), 7),
+                                     (dict(vOut=[-1e4, 0.0, 1e4]), 3)])
+def test_velocity_grid(lp, em, grid, n):
+    TB, vOut = lp.lineProfLTE(em, 1, 0, R, denProf=1.0, TProf=10.0,
+                              **grid)
+    assert vOut.shape == (n,) and TB.shape == (n,)
+    if 'dv' in grid:
+        np.testing.assert_allclose(np.diff(vOut), grid['dv'])
+        assert vOut[0] == -vOut[-1]
+
+
+def test_compiled_failure(lp, em):
+    # The compiled integrator flags a failure with nan, which must
+    # come back as an error
+    with pytest.raises(lp.despoticError):
+        lp.lineProfLTE(em, 1, 0, R, nOut=5, integrator='rk45', mxstep=2,
+                       **collapse)
+    with pytest.raises(lp.despoticError):
+        lp.lineProfLTE(em, 1, 0, R, nOut=5, beamdisp=0.3, mxstep=2,
+                       **collapse)
+    te = lp._transferEqn(em, 1, 0, R, collapse['denProf'],
+                         collapse['TProf'], collapse['vProf'], 0.0, 0.0)
+    with pytest.raises(lp.despoticError):
+        lp.LineProfLTE_pencil(0.0, te, mxstep=2)